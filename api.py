@@ -5,38 +5,189 @@ Backend FastAPI - SteamPulse Price Analytics
 Sirve el dashboard desde templates/ y expone endpoints de datos.
 """
 
-import os
+import asyncio
 import datetime
+import hashlib
+import os
 from contextlib import asynccontextmanager
 from typing import Optional
 
 import duckdb
+import httpx
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
 from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.templating import Jinja2Templates
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.decorator import cache
+
+try:                                    # solo los usan /predict y /refresh
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = pd = None
+
+try:                                    # opcional: HTTP/2 en las llamadas de /refresh
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
 
 # ── CONFIG ────────────────────────────────────────────────────
-PARQUET_GLOB = os.getenv("PARQUET_GLOB", "histograms/**/*.parquet")
+PARQUET_GLOB = os.getenv("PARQUET_GLOB", "histograms_v2/**/*.parquet")   # generado por build_db.py
 ITAD_KEY     = os.getenv("ITAD_KEY", "")
+CACHE_TTL    = int(os.getenv("CACHE_TTL", "300"))   # segundos; /refresh invalida antes
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", os.cpu_count() or 1))
+DUCKDB_MEMORY  = os.getenv("DUCKDB_MEMORY", "2GB")
+DUCKDB_POOL_SIZE = int(os.getenv("DUCKDB_POOL_SIZE", 2 * (os.cpu_count() or 1)))
+ITAD_CONCURRENCY = int(os.getenv("ITAD_CONCURRENCY", "10"))   # appids en vuelo en /refresh
 
 _con: duckdb.DuckDBPyConnection = None
+_pool: asyncio.Queue = None             # cursores de _con, uno por query en curso
+_drain_lock = asyncio.Lock()            # evita que dos /refresh vacíen el pool a medias
+_data_version: str = ""                 # huella de los datos (data_version); base de los ETag
+_year_bounds: tuple = (None, None)      # (MIN(year), MAX(year)) de price_history
+_itad_ids: dict = {}                    # appid → ITAD game id; el lookup no cambia entre /refresh
+
+# Endpoints de datos que responden con ETag / 304
+ETAG_PREFIXES = ("/bootstrap", "/summary", "/years", "/games", "/top-discounts", "/search")
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+PREDICT_MAX_DAYS = 180
+APPID_MAX_DIGITS = 10    # los appids de Steam caben de sobra en 10 cifras
+# Desplazamientos (en segundos) de los días a predecir; /predict toma un slice
+_DAY_OFFSETS = 86400.0 * np.arange(1, PREDICT_MAX_DAYS + 1) if np is not None else None
+
+
+class NumpyORJSONResponse(ORJSONResponse):
+    """ORJSONResponse que además acepta escalares/arrays de numpy."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware que deja pasar sin comprimir las rutas de exclude_paths."""
+
+    def __init__(self, app, exclude_paths: tuple = (), **kwargs):
+        super().__init__(app, **kwargs)
+        self.exclude_paths = set(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.exclude_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global _con
-    _con = duckdb.connect(config={"memory_limit": "128MB", "threads": 1})
-
+    global _con, _pool, _data_version
+    _con = duckdb.connect(config={"memory_limit": DUCKDB_MEMORY, "threads": DUCKDB_THREADS})
+
+    # Los footers/esquemas Parquet se leen una vez y quedan en caché entre queries
+    _con.execute("SET parquet_metadata_cache = true")
+
+    # En el árbol original (histograms/) appid sale de la partición id=<appid>:
+    # así los filtros por appid descartan archivos enteros. En histograms_v2/
+    # (year/appid_bucket) appid va dentro del archivo, ordenado, y el filtro
+    # se resuelve con las estadísticas de cada row group.
+    cols = {row[0] for row in _con.execute(
+        f"DESCRIBE SELECT * FROM read_parquet('{PARQUET_GLOB}', hive_partitioning=true, "
+        f"union_by_name=true)"
+    ).fetchall()}
+    appid_col = "id" if "id" in cols else "appid"
+    hive_types = {k: "BIGINT" for k in ("year", "id", "appid_bucket") if k in cols}
+
+    # union_by_name: sin él DuckDB toma el tipo de cada columna del primer archivo
+    # que lee, y si ese guardó price_usd como entero los DOUBLE de los demás se
+    # truncan antes del cast (14.99 -> 15). Con el esquema unificado el ::DOUBLE
+    # ya no pierde decimales; parquet_metadata_cache abarata leer cada footer.
+    # Las claves hive se declaran porque no se autodetectan. DuckDB ya proyecta
+    # solo las columnas que usa cada query a través de la vista.
     _con.execute(f"""
         CREATE OR REPLACE VIEW price_history AS
-        SELECT timestamp, price_usd, regular_usd, cut_pct,
-               shop_id, shop_name, appid, year
-        FROM read_parquet('{PARQUET_GLOB}', hive_partitioning=true)
+        SELECT timestamp::TIMESTAMPTZ   AS timestamp,
+               price_usd::DOUBLE        AS price_usd,
+               regular_usd::DOUBLE      AS regular_usd,
+               cut_pct::INTEGER         AS cut_pct,
+               shop_id::BIGINT          AS shop_id,
+               shop_name::VARCHAR       AS shop_name,
+               {appid_col}              AS appid,
+               year
+        FROM read_parquet('{PARQUET_GLOB}', hive_partitioning=true, union_by_name=true,
+                          hive_types={hive_types!r})
     """)
 
-    _con.execute("""
-        CREATE OR REPLACE VIEW game_stats AS
+    build_game_stats(_con)
+    load_year_bounds(_con)
+    _data_version = data_version(_con)
+    app.state.bootstrap = build_bootstrap(_con)
+    # Con prefix vacío InMemoryBackend.clear() no borra nada; /refresh depende de él
+    FastAPICache.init(InMemoryBackend(), prefix="steampulse")
+
+    _pool = asyncio.Queue(maxsize=DUCKDB_POOL_SIZE)
+    for _ in range(DUCKDB_POOL_SIZE):
+        _pool.put_nowait(_con.cursor())
+
+    # index.html no usa contexto de Jinja: se renderiza una sola vez
+    app.state.dashboard_html = templates.get_template("index.html").render()
+
+    yield
+    while not _pool.empty():
+        _pool.get_nowait().close()
+    _con.close()
+
+
+app = FastAPI(title="SteamPulse API", lifespan=lifespan,
+              default_response_class=NumpyORJSONResponse)
+templates = Jinja2Templates(directory="templates")
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=False,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+# Los historiales en JSON repiten shop_name/timestamps: comprimen 5-10x
+app.add_middleware(
+    SelectiveGZipMiddleware,
+    minimum_size=1024,
+    compresslevel=6,
+    exclude_paths=("/", "/health"),
+)
+
+
+@app.middleware("http")
+async def etag_middleware(request: Request, call_next):
+    """ETag débil por versión de datos + ruta + query; If-None-Match coincidente → 304."""
+    if request.method != "GET" or not request.url.path.startswith(ETAG_PREFIXES):
+        return await call_next(request)
+
+    args = f"{request.url.path}?{sorted(request.query_params.multi_items())}"
+    etag = f'W/"{_data_version}-{hashlib.md5(args.encode()).hexdigest()[:16]}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def build_game_stats(con: duckdb.DuckDBPyConnection):
+    """Materializa game_stats como tabla para no re-agregar los parquets en cada request."""
+    con.execute("""
+        CREATE OR REPLACE TABLE game_stats AS
         SELECT
             appid,
             COUNT(*)                    AS total_records,
@@ -48,32 +199,185 @@ async def lifespan(app: FastAPI):
             MAX(cut_pct)                AS max_discount
         FROM price_history
         GROUP BY appid
+        ORDER BY appid
     """)
 
-    yield
-    _con.close()
 
+def load_year_bounds(con: duckdb.DuckDBPyConnection):
+    global _year_bounds
+    _year_bounds = con.execute("SELECT MIN(year), MAX(year) FROM price_history").fetchone()
 
-app = FastAPI(title="SteamPulse API", lifespan=lifespan)
-templates = Jinja2Templates(directory="templates")
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=False,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+def data_version(con: duckdb.DuckDBPyConnection) -> str:
+    """Huella de game_stats: mismos datos → misma versión en cualquier worker.
+
+    Con varios workers de uvicorn un valor aleatorio por proceso cambiaba el ETag
+    según qué worker atendiera, y el 304 casi nunca se daba. bit_xor no depende
+    del orden de las filas; hash() de DuckDB es estable entre procesos.
+    """
+    (h,) = con.execute("""
+        SELECT bit_xor(hash(appid, total_records, first_seen, last_seen,
+                            min_price, max_price, avg_price, max_discount))
+        FROM game_stats
+    """).fetchone()
+    return f"{h or 0:016x}"
+
+
+def year_window(since: Optional[str], until: Optional[str]) -> tuple:
+    """Rango de particiones year= que puede tocar [since, until].
+
+    Un 1-ene / 31-dic se amplía un año: con offset horario el instante puede caer
+    en el año vecino. Si la fecha no se puede leer se deja el rango completo y
+    DuckDB valida el formato.
+    """
+    lo, hi = _year_bounds
+    try:
+        if since:
+            d = datetime.date.fromisoformat(since[:10])
+            lo = max(lo, d.year - (d.month == 1 and d.day == 1))
+        if until:
+            d = datetime.date.fromisoformat(until[:10])
+            hi = min(hi, d.year + (d.month == 12 and d.day == 31))
+    except (ValueError, TypeError):
+        return _year_bounds
+    return lo, hi
+
+
+def appid_prefix_ranges(prefix: str, max_digits: int = APPID_MAX_DIGITS) -> list:
+    """Rangos [lo, hi] de appids cuya representación decimal empieza por prefix.
+
+    "73" → (73, 73), (730, 739), (7300, 7399), ... hasta max_digits cifras.
+    """
+    base = int(prefix)
+    return [
+        (base * 10 ** k, (base + 1) * 10 ** k - 1)
+        for k in range(max_digits - len(prefix) + 1)
+    ]
+
+
+def fetch_records(cur) -> list:
+    """Materializa el resultado vía Arrow, sin pasar por un DataFrame de pandas."""
+    return cur.fetch_arrow_table().to_pylist()
+
+
+def arrow_ipc_bytes(table: pa.Table) -> bytes:
+    """Serializa la tabla como stream IPC de Arrow (el cliente la lee sin parsear JSON)."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _itad_amount(obj) -> Optional[float]:
+    if obj is None:
+        return None
+    amount = obj.get("amount", 0)
+    return None if amount is None else float(amount)
+
+
+def _itad_row(entry: dict) -> tuple:
+    """Una entrada de /games/history/v2 → valores de fila. Lanza si no tiene la forma esperada."""
+    ts = entry.get("timestamp", "")
+    if not isinstance(ts, str):
+        raise TypeError(f"timestamp no es texto: {ts!r}")
+    shop = entry.get("shop") or {}
+    cut = entry.get("cut", 0)
+    return (ts,
+            _itad_amount(entry.get("price", {})),
+            _itad_amount(entry.get("regular", {})),
+            None if cut is None else int(cut),
+            shop.get("id"),
+            shop.get("name", "Steam"))
+
+
+def itad_history_table(fetched: list) -> tuple:
+    """Pares (appid, entradas de /games/history/v2) → (tabla Arrow para price_history,
+    appids descartados).
+
+    Se rellenan listas por columna y los timestamps se parsean de una vez,
+    sin pasar por un dict por fila ni por la inferencia de pd.DataFrame.
+    Cada app se valida por separado: si una entrada no tiene la forma esperada
+    se descarta esa app (/refresh la cuenta como error) y no el refresh entero.
+    Un timestamp que no parsea descarta solo su fila.
+    """
+    ts, price, regular, cut, shop_id, shop_name, appids = [], [], [], [], [], [], []
+    rejected = set()
+    for appid, entries in fetched:
+        try:
+            rows = [_itad_row(entry) for entry in entries]
+        except (AttributeError, TypeError, ValueError):
+            rejected.add(appid)
+            continue
+        for row in rows:
+            ts.append(row[0])
+            price.append(row[1])
+            regular.append(row[2])
+            cut.append(row[3])
+            shop_id.append(row[4])
+            shop_name.append(row[5])
+        appids.extend([appid] * len(rows))
+
+    # ISO8601 acepta 'Z', '+hh:mm' y fracciones mezclados; lo que no parsea queda NaT
+    stamps = pa.array(pd.to_datetime(ts, utc=True, format="ISO8601", errors="coerce"))
+    table = pa.table({
+        "timestamp": stamps,
+        "price_usd": pa.array(price, pa.float64()),
+        "regular_usd": pa.array(regular, pa.float64()),
+        "cut_pct": pa.array(cut, pa.int64()),
+        "shop_id": pa.array(shop_id),       # tipo inferido, como hacía pd.DataFrame
+        "shop_name": pa.array(shop_name, pa.string()),
+        "appid": pa.array(appids, pa.int64()),
+        "year": pc.year(stamps),
+    })
+    return table.filter(pc.is_valid(table["timestamp"])), rejected
+
+
+def fetch_record(cur) -> Optional[dict]:
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return dict(zip((col[0] for col in cur.description), row))
 
 
-def db():
-    return _con
+@asynccontextmanager
+async def exclusive_cursor():
+    """Vacía el pool para que ninguna query corra mientras /refresh reemplaza las tablas."""
+    async with _drain_lock:
+        held = []
+        try:
+            # De a uno dentro del try: si se cancela a mitad de vaciar el pool
+            # (p.ej. el cliente corta la conexión) los ya tomados se devuelven
+            for _ in range(DUCKDB_POOL_SIZE):
+                held.append(await _pool.get())
+            yield held[0]
+        finally:
+            for cur in held:
+                _pool.put_nowait(cur)
+
+
+async def run_query(sql: str, params: Optional[list] = None, fetch=fetch_records):
+    """Ejecuta sql en un cursor del pool dentro del threadpool y aplica fetch al resultado.
+
+    Si están todos los cursores en uso espera a que se libere uno. Cancelar la
+    request no corta la query del threadpool: el cursor vuelve al pool recién
+    cuando la query termina, nunca mientras otro hilo lo sigue usando.
+    """
+    cur = await _pool.get()
+    job = asyncio.ensure_future(run_in_threadpool(lambda: fetch(cur.execute(sql, params))))
+
+    def release(done):
+        _pool.put_nowait(cur)
+        if not done.cancelled():
+            done.exception()    # la marca como vista si nadie la espera ya
+
+    job.add_done_callback(release)
+    return await asyncio.shield(job)
 
 
 # ── GET / → Dashboard ─────────────────────────────────────────
 @app.get("/", response_class=HTMLResponse)
 async def dashboard(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return HTMLResponse(request.app.state.dashboard_html)
 
 
 # ── GET /health ───────────────────────────────────────────────
@@ -83,140 +387,207 @@ def health():
 
 
 # ── GET /summary ──────────────────────────────────────────────
+SUMMARY_SQL = """
+    SELECT
+        COUNT(DISTINCT appid)       AS total_games,
+        COUNT(*)                    AS total_records,
+        MIN(year)                   AS year_from,
+        MAX(year)                   AS year_to,
+        ROUND(AVG(price_usd), 2)    AS global_avg_price,
+        MIN(price_usd)              AS global_min_price,
+        MAX(price_usd)              AS global_max_price
+    FROM price_history
+"""
+
+
 @app.get("/summary")
-def summary():
-    row = db().execute("""
-        SELECT
-            COUNT(DISTINCT appid)       AS total_games,
-            COUNT(*)                    AS total_records,
-            MIN(year)                   AS year_from,
-            MAX(year)                   AS year_to,
-            ROUND(AVG(price_usd), 2)    AS global_avg_price,
-            MIN(price_usd)              AS global_min_price,
-            MAX(price_usd)              AS global_max_price
-        FROM price_history
-    """).fetchdf()
-    return row.iloc[0].to_dict()
+@cache(expire=CACHE_TTL)
+async def summary():
+    return await run_query(SUMMARY_SQL, fetch=fetch_record)
 
 
 # ── GET /years ────────────────────────────────────────────────
+YEARS_SQL = """
+    SELECT year, COUNT(DISTINCT appid) AS games, COUNT(*) AS records
+    FROM price_history
+    GROUP BY year ORDER BY year
+"""
+
+
 @app.get("/years")
-def available_years():
-    rows = db().execute("""
-        SELECT year, COUNT(DISTINCT appid) AS games, COUNT(*) AS records
-        FROM price_history
-        GROUP BY year ORDER BY year
-    """).fetchdf()
-    return rows.to_dict(orient="records")
+@cache(expire=CACHE_TTL)
+async def available_years():
+    return await run_query(YEARS_SQL)
 
 
 # ── GET /games ────────────────────────────────────────────────
+GAMES_SQL = """
+    SELECT appid, total_records, first_seen, last_seen,
+           min_price, max_price, avg_price, max_discount
+    FROM game_stats
+    ORDER BY total_records DESC
+    LIMIT $1 OFFSET $2
+"""
+
+
 @app.get("/games")
-def list_games(limit: int = Query(50, le=200), offset: int = 0):
-    rows = db().execute(f"""
-        SELECT appid, total_records, first_seen, last_seen,
-               min_price, max_price, avg_price, max_discount
-        FROM game_stats
-        ORDER BY total_records DESC
-        LIMIT {limit} OFFSET {offset}
-    """).fetchdf()
-    return rows.to_dict(orient="records")
+@cache(expire=CACHE_TTL)
+async def list_games(limit: int = Query(50, le=200), offset: int = 0):
+    return await run_query(GAMES_SQL, [limit, offset])
 
 
 # ── GET /games/{appid} ────────────────────────────────────────
 @app.get("/games/{appid}")
-def game_detail(appid: int):
-    row = db().execute(f"SELECT * FROM game_stats WHERE appid = {appid}").fetchdf()
-    if row.empty:
+async def game_detail(appid: int):
+    row = await run_query("SELECT * FROM game_stats WHERE appid = $1", [appid], fetch=fetch_record)
+    if row is None:
         raise HTTPException(404, f"appid {appid} no encontrado")
-    return row.iloc[0].to_dict()
+    return row
 
 
 # ── GET /games/{appid}/history ────────────────────────────────
 @app.get("/games/{appid}/history")
-def price_history(
+async def price_history(
     appid: int,
     since: Optional[str] = None,
     until: Optional[str] = None,
     year: Optional[int] = None,
+    fmt: str = Query("json", alias="format", pattern="^(json|arrow)$"),
 ):
-    filters = [f"appid = {appid}"]
-    if year:  filters.append(f"year = {year}")
-    if since: filters.append(f"timestamp >= '{since}'")
-    if until: filters.append(f"timestamp <= '{until}'")
-
-    rows = db().execute(f"""
-        SELECT timestamp::VARCHAR AS timestamp, price_usd, regular_usd, cut_pct, shop_name
-        FROM price_history
-        WHERE {" AND ".join(filters)}
-        ORDER BY timestamp
-    """).fetchdf()
-
-    if rows.empty:
+    # Siempre se acota year para que DuckDB pode particiones antes de abrir archivos
+    year_lo, year_hi = (year, year) if year else year_window(since, until)
+    try:
+        table = await run_query("""
+            SELECT timestamp::VARCHAR AS timestamp, price_usd, regular_usd, cut_pct, shop_name
+            FROM price_history
+            WHERE appid = $1
+              AND year BETWEEN $2 AND $3
+              AND ($4::TIMESTAMPTZ IS NULL OR timestamp >= $4)
+              AND ($5::TIMESTAMPTZ IS NULL OR timestamp <= $5)
+            ORDER BY timestamp
+        """, [appid, year_lo, year_hi, since or None, until or None],
+            fetch=lambda cur: cur.fetch_arrow_table())
+    except duckdb.ConversionException:
+        raise HTTPException(400, "Formato de fecha inválido en since/until (use YYYY-MM-DD)")
+
+    if table.num_rows == 0:
         raise HTTPException(404, f"Sin historial para appid {appid}")
-    return {"appid": appid, "count": len(rows), "history": rows.to_dict(orient="records")}
+    if fmt == "arrow":
+        return Response(arrow_ipc_bytes(table), media_type=ARROW_STREAM)
+    # Arrow → objetos Python → orjson, sin DataFrame ni jsonable_encoder de por medio
+    return NumpyORJSONResponse({"appid": appid, "count": table.num_rows, "history": table.to_pylist()})
 
 
 # ── GET /top-discounts ────────────────────────────────────────
+TOP_DISCOUNTS_SQL = """
+    SELECT appid, max_discount, min_price, avg_price
+    FROM game_stats
+    WHERE max_discount > 0
+    ORDER BY max_discount DESC
+    LIMIT $1
+"""
+
+
 @app.get("/top-discounts")
-def top_discounts(limit: int = Query(10, le=50)):
-    rows = db().execute(f"""
-        SELECT appid, max_discount, min_price, avg_price
-        FROM game_stats
-        WHERE max_discount > 0
-        ORDER BY max_discount DESC
-        LIMIT {limit}
-    """).fetchdf()
-    return rows.to_dict(orient="records")
+@cache(expire=CACHE_TTL)
+async def top_discounts(limit: int = Query(10, le=50)):
+    return await run_query(TOP_DISCOUNTS_SQL, [limit])
+
+
+# ── GET /bootstrap ────────────────────────────────────────────
+# Lo que pide el dashboard al cargar, con los mismos límites que usa index.html
+BOOTSTRAP_GAMES = 200
+BOOTSTRAP_TOP_DISCOUNTS = 5
+
+
+def build_bootstrap(con: duckdb.DuckDBPyConnection) -> dict:
+    """Calcula el payload de /bootstrap; se rehace en el arranque y en /refresh."""
+    return {
+        "summary": fetch_record(con.execute(SUMMARY_SQL)),
+        "years": fetch_records(con.execute(YEARS_SQL)),
+        "games": fetch_records(con.execute(GAMES_SQL, [BOOTSTRAP_GAMES, 0])),
+        "top_discounts": fetch_records(con.execute(TOP_DISCOUNTS_SQL, [BOOTSTRAP_TOP_DISCOUNTS])),
+    }
+
+
+@app.get("/bootstrap")
+async def bootstrap(request: Request):
+    return request.app.state.bootstrap
 
 
 # ── GET /search ───────────────────────────────────────────────
 @app.get("/search")
-def search_games(q: str = Query(..., min_length=1), limit: int = 10):
-    rows = db().execute(f"""
+async def search_games(q: str = Query(..., min_length=1), limit: int = 10):
+    # appid numérico: los prefijos se resuelven con rangos enteros sobre game_stats
+    # (ordenada por appid, así que los zonemaps descartan row groups) y solo si
+    # faltan resultados se recurre al LIKE de subcadena, que castea cada fila.
+    prefix_rows = []
+    numeric = q.isascii() and q.isdigit() and q[0] != "0" and len(q) <= APPID_MAX_DIGITS
+    if numeric:
+        ranges = appid_prefix_ranges(q)
+        where = " OR ".join(
+            f"appid BETWEEN ${2 * i + 1} AND ${2 * i + 2}" for i in range(len(ranges))
+        )
+        prefix_rows = await run_query(f"""
+            SELECT appid, total_records, avg_price, max_discount
+            FROM game_stats
+            WHERE {where}
+            ORDER BY total_records DESC
+            LIMIT ${2 * len(ranges) + 1}
+        """, [v for r in ranges for v in r] + [limit])
+        if len(prefix_rows) >= limit:
+            return prefix_rows
+
+    pattern = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return prefix_rows + await run_query("""
         SELECT appid, total_records, avg_price, max_discount
         FROM game_stats
-        WHERE CAST(appid AS VARCHAR) LIKE '%{q}%'
+        WHERE CAST(appid AS VARCHAR) LIKE '%' || $1 || '%' ESCAPE '\\'
+          AND NOT ($2 AND starts_with(CAST(appid AS VARCHAR), $1))
         ORDER BY total_records DESC
-        LIMIT {limit}
-    """).fetchdf()
-    return rows.to_dict(orient="records")
+        LIMIT $3
+    """, [pattern, numeric, limit - len(prefix_rows)])
 
 
 # ── GET /games/{appid}/predict ────────────────────────────────
 @app.get("/games/{appid}/predict")
-def predict_price(appid: int, days: int = Query(30, le=180)):
-    try:
-        import numpy as np
-        from sklearn.linear_model import LinearRegression
-    except ImportError:
-        raise HTTPException(500, "numpy/scikit-learn no instalado")
+async def predict_price(appid: int, days: int = Query(30, ge=1, le=PREDICT_MAX_DAYS)):
+    if np is None or pd is None:
+        raise HTTPException(500, "numpy/pandas no instalado")
 
-    rows = db().execute(f"""
+    rows = await run_query("""
         SELECT epoch(timestamp) AS ts_epoch, price_usd
         FROM price_history
-        WHERE appid = {appid} AND price_usd IS NOT NULL AND price_usd > 0
+        WHERE appid = $1 AND price_usd IS NOT NULL AND price_usd > 0
         ORDER BY timestamp
-    """).fetchdf()
+    """, [appid], fetch=lambda cur: cur.fetchdf())
 
     if len(rows) < 5:
         raise HTTPException(400, "Historial insuficiente (mínimo 5 puntos)")
 
-    X = rows["ts_epoch"].values.reshape(-1, 1)
-    y = rows["price_usd"].values
-    model = LinearRegression().fit(X, y)
+    ts = rows["ts_epoch"].to_numpy(dtype=np.float64)
+    y = rows["price_usd"].to_numpy(dtype=np.float64)
+
+    # Regresión lineal de una variable en forma cerrada (ts centrado para estabilidad)
+    tsc = ts - ts.mean()
+    ss_ts = (tsc * tsc).sum()
+    slope = (tsc * y).sum() / ss_ts if ss_ts else 0.0
+    intercept = y.mean() - slope * ts.mean()
+
+    ss_tot = ((y - y.mean()) ** 2).sum()
+    ss_res = ((y - (slope * ts + intercept)) ** 2).sum()
+    r2 = 1.0 - ss_res / ss_tot if ss_tot else 1.0
 
-    last_ts = X[-1][0]
-    future_epochs = [last_ts + 86400 * i for i in range(1, days + 1)]
-    preds = [max(0.0, round(float(p), 2)) for p in model.predict([[e] for e in future_epochs])]
-    dates = [datetime.datetime.fromtimestamp(e).strftime("%Y-%m-%d") for e in future_epochs]
+    future = ts[-1] + _DAY_OFFSETS[:days]
+    preds = np.maximum(0.0, slope * future + intercept).round(2).tolist()
+    dates = pd.to_datetime(future, unit="s").strftime("%Y-%m-%d").tolist()
 
     return {
         "appid": appid,
         "days": days,
-        "r2_score": round(float(model.score(X, y)), 4),
-        "trend": "down" if model.coef_[0] < 0 else "up",
-        "current_price": round(float(y[-1]), 2),
+        "r2_score": round(r2, 4),
+        "trend": "down" if slope < 0 else "up",
+        "current_price": round(y[-1], 2),
         "predicted_price_end": preds[-1],
         "predictions": [{"date": d, "price_usd": p} for d, p in zip(dates, preds)],
     }
@@ -232,8 +603,10 @@ async def refresh_data(
     Llama a ITAD API y recarga datos en memoria.
     Si no se pasa itad_key, usa la variable de entorno ITAD_KEY.
     """
-    import httpx
-    import pandas as pd
+    global _data_version
+
+    if pd is None:
+        raise HTTPException(500, "pandas no instalado")
 
     key = itad_key or ITAD_KEY
     if not key:
@@ -241,80 +614,83 @@ async def refresh_data(
 
     ITAD_BASE = "https://api.isthereanydeal.com"
     results = {"loaded": 0, "errors": 0, "games": []}
-    rows_all = []
-
-    async with httpx.AsyncClient(timeout=30) as client:
-        try:
-            spy = await client.get("https://steamspy.com/api.php", params={"request": "top100forever"})
-            appids = list(spy.json().keys())[:top_n]
-        except Exception as e:
-            raise HTTPException(500, f"SteamSpy error: {e}")
-
-        for appid_str in appids:
-            appid = int(appid_str)
-            try:
+    loaded = []     # (appid, entradas de historial)
+    sem = asyncio.Semaphore(ITAD_CONCURRENCY)   # peticiones concurrentes a ITAD
+
+    async def fetch_one(client, appid: int) -> Optional[list]:
+        """Entradas de historial ITAD de un appid. None si ITAD no lo tiene."""
+        async with sem:
+            game_id = _itad_ids.get(appid)
+            if game_id is None:
                 lookup = await client.get(
                     f"{ITAD_BASE}/games/lookup/v1",
                     params={"key": key, "appid": appid},
                 )
                 if lookup.status_code != 200:
-                    results["errors"] += 1
-                    continue
+                    return None
 
                 game_id = lookup.json().get("game", {}).get("id")
                 if not game_id:
-                    results["errors"] += 1
-                    continue
+                    return None
+                _itad_ids[appid] = game_id
+
+            hist = await client.get(
+                f"{ITAD_BASE}/games/history/v2",
+                params={"key": key, "id": game_id, "country": "US",
+                        "since": "2020-01-01T00:00:00Z"},
+            )
+            if hist.status_code != 200:
+                return None
+
+        return hist.json().get("prices", [])
+
+    # Con h2 las peticiones a ITAD se multiplexan sobre 1-2 conexiones TLS. El pool
+    # no pasa del semáforo: nunca hay más peticiones en vuelo que conexiones.
+    limits = httpx.Limits(max_connections=ITAD_CONCURRENCY,
+                          max_keepalive_connections=ITAD_CONCURRENCY)
+    async with httpx.AsyncClient(http2=HTTP2, timeout=30, limits=limits) as client:
+        try:
+            spy = await client.get("https://steamspy.com/api.php", params={"request": "top100forever"})
+            appids = [int(a) for a in list(spy.json().keys())[:top_n]]
+        except Exception as e:
+            raise HTTPException(500, f"SteamSpy error: {e}")
 
-                hist = await client.get(
-                    f"{ITAD_BASE}/games/history/v2",
-                    params={"key": key, "id": game_id, "country": "US",
-                            "since": "2020-01-01T00:00:00Z"},
-                )
-                if hist.status_code != 200:
-                    results["errors"] += 1
-                    continue
-
-                for entry in hist.json().get("prices", []):
-                    ts = pd.Timestamp(entry.get("timestamp", ""))
-                    rows_all.append({
-                        "timestamp": ts,
-                        "price_usd": entry.get("price", {}).get("amount", 0),
-                        "regular_usd": entry.get("regular", {}).get("amount", 0),
-                        "cut_pct": entry.get("cut", 0),
-                        "shop_id": entry.get("shop", {}).get("id", ""),
-                        "shop_name": entry.get("shop", {}).get("name", "Steam"),
-                        "appid": appid,
-                        "year": ts.year,
-                    })
-
-                results["loaded"] += 1
-                results["games"].append(appid)
-
-            except Exception:
-                results["errors"] += 1
-                continue
-
-    if not rows_all:
+        fetched = await asyncio.gather(*(fetch_one(client, a) for a in appids),
+                                       return_exceptions=True)
+
+    for appid, rows in zip(appids, fetched):
+        if rows is None or isinstance(rows, Exception):
+            results["errors"] += 1
+            continue
+        loaded.append((appid, rows))
+
+    # Una app con entradas mal formadas cuenta como error, igual que un fetch fallido
+    table, rejected = itad_history_table(loaded)
+    for appid, _ in loaded:
+        if appid in rejected:
+            results["errors"] += 1
+        else:
+            results["loaded"] += 1
+            results["games"].append(appid)
+
+    if table.num_rows == 0:
         raise HTTPException(500, "No se pudieron cargar datos de ITAD")
-
-    df = pd.DataFrame(rows_all)
-    db().execute("DROP VIEW IF EXISTS price_history")
-    db().execute("DROP VIEW IF EXISTS game_stats")
-    db().register("_df", df)
-    db().execute("CREATE OR REPLACE VIEW price_history AS SELECT * FROM _df")
-    db().execute("""
-        CREATE OR REPLACE VIEW game_stats AS
-        SELECT appid,
-            COUNT(*)                    AS total_records,
-            MIN(timestamp)::VARCHAR     AS first_seen,
-            MAX(timestamp)::VARCHAR     AS last_seen,
-            MIN(price_usd)              AS min_price,
-            MAX(price_usd)              AS max_price,
-            ROUND(AVG(price_usd), 2)    AS avg_price,
-            MAX(cut_pct)                AS max_discount
-        FROM price_history GROUP BY appid
-    """)
-
-    results["total_records"] = len(df)
+    # Lo registrado con register() es local al cursor: se copia a una tabla del catálogo
+    # para que los cursores del resto de requests vean los datos nuevos. El pool se vacía
+    # antes para no cambiar price_history a mitad de una query.
+    async with exclusive_cursor() as con:
+        con.register("_df", table)
+        con.execute("CREATE OR REPLACE TABLE refresh_prices AS SELECT * FROM _df")
+        con.unregister("_df")
+        con.execute("CREATE OR REPLACE VIEW price_history AS SELECT * FROM refresh_prices")
+        build_game_stats(con)
+        load_year_bounds(con)
+        version = data_version(con)
+        app.state.bootstrap = build_bootstrap(con)
+    # La versión cambia después de vaciar la caché: antes un ETag nuevo podría
+    # quedar asociado a una respuesta cacheada con los datos viejos
+    await FastAPICache.clear()
+    _data_version = version
+
+    results["total_records"] = table.num_rows
     return results
\ No newline at end of file
@@ -3,9 +3,13 @@ build_db.py
 ===========
 Convierte los parquets de histograms/ a una base de datos DuckDB.
 
+Además reescribe price_history en histograms_v2/ como Parquet compacto
+(ordenado por appid, timestamp, ZSTD) particionado por year/appid_bucket,
+que es el árbol que lee api.py.
+
 Uso:
   pip install duckdb pandas pyarrow
-  python build_db.py --parquet-dir histograms --db steam.db
+  python build_db.py --parquet-dir histograms --db steam.db --export-dir histograms_v2
 """
 
 import argparse
@@ -17,15 +21,46 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(mess
 logger = logging.getLogger("build_db")
 
 
-def build(parquet_dir: str, db_path: str):
+def export_parquet(con, out_dir: str, buckets: int = 64):
+    """
+    Vuelca price_history a out_dir/year=Y/appid_bucket=B/*.parquet.
+    Al ir ordenado por appid, el min/max de cada row group permite a DuckDB
+    saltarse casi todo el archivo en consultas de un solo juego.
+    """
+    logger.info("Exportando price_history a %s/ (%d buckets) ...", out_dir, buckets)
+    con.execute(f"""
+        COPY (
+            SELECT timestamp, price_usd, regular_usd, cut_pct,
+                   shop_id, shop_name, appid, year,
+                   appid % {buckets} AS appid_bucket
+            FROM price_history
+            ORDER BY appid, timestamp
+        ) TO '{out_dir}' (
+            FORMAT PARQUET,
+            PARTITION_BY (year, appid_bucket),
+            ROW_GROUP_SIZE 100000,
+            COMPRESSION ZSTD,
+            COMPRESSION_LEVEL 3,
+            OVERWRITE
+        )
+    """)
+
+
+def build(parquet_dir: str, db_path: str, export_dir: str = "histograms_v2", buckets: int = 64):
     con = duckdb.connect(db_path)
 
     logger.info("Creando tabla price_history desde %s/**/*.parquet ...", parquet_dir)
 
+    # steam_price_history.py agrega un data-<uuid>.parquet por ejecucion sin
+    # reescribir los anteriores: aqui se compacta quitando los repetidos.
+    # union_by_name unifica el esquema de todos los archivos; sin el, DuckDB usa
+    # los tipos del primero y, si guardo price_usd como entero, trunca los
+    # precios DOUBLE del resto (14.99 -> 15).
     con.execute(f"""
         CREATE OR REPLACE TABLE price_history AS
-        SELECT *
-        FROM read_parquet('{parquet_dir}/**/data.parquet', hive_partitioning=true)
+        SELECT DISTINCT ON (appid, timestamp, shop_id) *
+        FROM read_parquet('{parquet_dir}/**/*.parquet', hive_partitioning=true,
+                          union_by_name=true)
         ORDER BY appid, timestamp
     """)
 
@@ -54,6 +89,9 @@ def build(parquet_dir: str, db_path: str):
         GROUP BY appid
     """)
 
+    if export_dir:
+        export_parquet(con, export_dir, buckets)
+
     con.close()
     size_mb = os.path.getsize(db_path) / 1024 / 1024
     logger.info("Base de datos guardada en %s (%.1f MB)", db_path, size_mb)
@@ -63,5 +101,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--parquet-dir", default="histograms")
     parser.add_argument("--db",          default="steam.db")
+    parser.add_argument("--export-dir",  default="histograms_v2",
+                        help="Árbol Parquet compacto para api.py ('' para omitirlo)")
+    parser.add_argument("--buckets",     type=int, default=64)
     args = parser.parse_args()
-    build(args.parquet_dir, args.db)
+    build(args.parquet_dir, args.db, args.export_dir, args.buckets)
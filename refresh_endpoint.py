@@ -8,110 +8,112 @@ async def refresh_data(
     Llama a IsThereAnyDeal API y recarga los datos en memoria.
     Los datos duran hasta que Render reinicia el servidor.
     """
-    import httpx
-    import pandas as pd
+    global _data_version
 
     ITAD_BASE = "https://api.isthereanydeal.com"
     results = {"loaded": 0, "errors": 0, "games": []}
+    sem = asyncio.Semaphore(ITAD_CONCURRENCY)   # peticiones concurrentes a ITAD
 
-    async with httpx.AsyncClient(timeout=30) as client:
-
-        # 1. Obtener lista de juegos populares de Steam via SteamSpy
-        try:
-            spy = await client.get(
-                "https://steamspy.com/api.php",
-                params={"request": "top100forever"},
-            )
-            spy_data = spy.json()
-            appids = list(spy_data.keys())[:top_n]
-        except Exception as e:
-            raise HTTPException(500, f"SteamSpy error: {e}")
-
-        rows_all = []
-
-        for appid_str in appids:
-            appid = int(appid_str)
-            try:
-                # 2. Buscar game_id en ITAD por Steam appid
+    async def fetch_one(client, appid: int):
+        """Filas de historial de un appid, o None si falla algún paso."""
+        async with sem:
+            # 2. Buscar game_id en ITAD por Steam appid (_itad_ids de api.py lo recuerda)
+            game_id = _itad_ids.get(appid)
+            if game_id is None:
                 lookup = await client.get(
                     f"{ITAD_BASE}/games/lookup/v1",
                     params={"key": itad_key, "appid": appid},
                 )
                 if lookup.status_code != 200:
-                    results["errors"] += 1
-                    continue
+                    return None
 
                 ldata = lookup.json()
                 game_id = ldata.get("game", {}).get("id")
                 if not game_id:
-                    results["errors"] += 1
-                    continue
+                    return None
+                _itad_ids[appid] = game_id
 
-                # 3. Obtener historial de precios
-                hist = await client.get(
-                    f"{ITAD_BASE}/games/history/v2",
-                    params={
-                        "key": itad_key,
-                        "id": game_id,
-                        "country": "US",
-                        "since": "2020-01-01T00:00:00Z",
-                    },
-                )
-                if hist.status_code != 200:
-                    results["errors"] += 1
-                    continue
+            # 3. Obtener historial de precios
+            hist = await client.get(
+                f"{ITAD_BASE}/games/history/v2",
+                params={
+                    "key": itad_key,
+                    "id": game_id,
+                    "country": "US",
+                    "since": "2020-01-01T00:00:00Z",
+                },
+            )
+            if hist.status_code != 200:
+                return None
 
-                hdata = hist.json()
-                prices = hdata.get("prices", [])
-                if not prices:
-                    results["errors"] += 1
-                    continue
+        hdata = hist.json()
+        prices = hdata.get("prices", [])
+        if not prices:
+            return None
 
-                for entry in prices:
-                    for shop_entry in entry.get("cut", [{}]):
-                        rows_all.append({
-                            "timestamp": pd.Timestamp(entry.get("timestamp", "")),
-                            "price_usd": entry.get("price", {}).get("amount", 0),
-                            "regular_usd": entry.get("regular", {}).get("amount", 0),
-                            "cut_pct": entry.get("cut", 0),
-                            "shop_id": entry.get("shop", {}).get("id", ""),
-                            "shop_name": entry.get("shop", {}).get("name", "Steam"),
-                            "appid": appid,
-                            "year": pd.Timestamp(entry.get("timestamp", "")).year,
-                        })
+        return [
+            entry
+            for entry in prices
+            for shop_entry in entry.get("cut", [{}])
+        ]
 
-                results["loaded"] += 1
-                results["games"].append(appid)
+    # Con h2 las peticiones a ITAD se multiplexan sobre 1-2 conexiones TLS. El pool
+    # no pasa del semáforo: nunca hay más peticiones en vuelo que conexiones.
+    limits = httpx.Limits(max_connections=ITAD_CONCURRENCY,
+                          max_keepalive_connections=ITAD_CONCURRENCY)
+    async with httpx.AsyncClient(http2=HTTP2, timeout=30, limits=limits) as client:
 
-            except Exception:
-                results["errors"] += 1
-                continue
+        # 1. Obtener lista de juegos populares de Steam via SteamSpy
+        try:
+            spy = await client.get(
+                "https://steamspy.com/api.php",
+                params={"request": "top100forever"},
+            )
+            spy_data = spy.json()
+            appids = [int(a) for a in list(spy_data.keys())[:top_n]]
+        except Exception as e:
+            raise HTTPException(500, f"SteamSpy error: {e}")
 
-    if not rows_all:
-        raise HTTPException(500, "No se pudieron cargar datos de ITAD")
+        fetched = await asyncio.gather(
+            *(fetch_one(client, appid) for appid in appids),
+            return_exceptions=True,
+        )
 
-    # 4. Cargar en DuckDB en memoria
-    import pandas as pd
-    df = pd.DataFrame(rows_all)
+    loaded = []
+    for appid, rows in zip(appids, fetched):
+        if rows is None or isinstance(rows, Exception):
+            results["errors"] += 1
+            continue
+        loaded.append((appid, rows))
+
+    # 4. Cargar en DuckDB en memoria (columnas Arrow, ver itad_history_table en api.py).
+    # Una app con entradas mal formadas cuenta como error, igual que un fetch fallido.
+    table, rejected = itad_history_table(loaded)
+    for appid, _ in loaded:
+        if appid in rejected:
+            results["errors"] += 1
+        else:
+            results["loaded"] += 1
+            results["games"].append(appid)
+
+    if table.num_rows == 0:
+        raise HTTPException(500, "No se pudieron cargar datos de ITAD")
 
-    db().execute("DROP VIEW IF EXISTS price_history")
-    db().execute("DROP VIEW IF EXISTS game_stats")
-    db().register("_refresh_df", df)
-    db().execute("CREATE OR REPLACE VIEW price_history AS SELECT * FROM _refresh_df")
-    db().execute("""
-        CREATE OR REPLACE VIEW game_stats AS
-        SELECT
-            appid,
-            COUNT(*)                        AS total_records,
-            MIN(timestamp)::VARCHAR         AS first_seen,
-            MAX(timestamp)::VARCHAR         AS last_seen,
-            MIN(price_usd)                  AS min_price,
-            MAX(price_usd)                  AS max_price,
-            ROUND(AVG(price_usd), 2)        AS avg_price,
-            MAX(cut_pct)                    AS max_discount
-        FROM price_history
-        GROUP BY appid
-    """)
+    # register() es local al cursor: se copia a una tabla del catálogo para que el
+    # resto de cursores del pool vean los datos. exclusive_cursor() (api.py) vacía
+    # el pool mientras tanto.
+    async with exclusive_cursor() as con:
+        con.register("_refresh_df", table)
+        con.execute("CREATE OR REPLACE TABLE refresh_prices AS SELECT * FROM _refresh_df")
+        con.unregister("_refresh_df")
+        con.execute("CREATE OR REPLACE VIEW price_history AS SELECT * FROM refresh_prices")
+        # game_stats es una tabla materializada (ver build_game_stats en api.py)
+        build_game_stats(con)
+        load_year_bounds(con)
+        version = data_version(con)
+        app.state.bootstrap = build_bootstrap(con)
+    await FastAPICache.clear()
+    _data_version = version
 
-    results["total_records"] = len(df)
+    results["total_records"] = table.num_rows
     return results
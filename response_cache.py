@@ -0,0 +1,91 @@
+"""
+response_cache.py
+=================
+Caché persistente (SQLite) de respuestas JSON de Steam / ITAD para los
+recolectores. Así una segunda pasada no vuelve a pedir lo que ya se
+descargó hace poco.
+
+Clave: (endpoint, hash de los params). El parámetro "key" (API key) se
+excluye: no se guarda en disco y no separa entradas entre claves distintas.
+
+Si la respuesta traía ETag se guarda también: una entrada vencida se puede
+revalidar con If-None-Match (get_stale) y, ante un 304, renovar con touch().
+
+Uso:
+  cache = ResponseCache(".http_cache.sqlite")
+  data = cache.get("itad_lookup", params, ttl=LOOKUP_TTL)
+  if data is None:
+      data = r.json()
+      cache.set("itad_lookup", params, data)
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+
+SECRET_PARAMS = {"key"}
+
+
+class ResponseCache:
+    def __init__(self, path: str):
+        self.con = sqlite3.connect(path)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                endpoint    TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                fetched_at  REAL NOT NULL,
+                body        TEXT NOT NULL,
+                etag        TEXT,
+                PRIMARY KEY (endpoint, params_hash)
+            )
+        """)
+        # Caches creadas antes de que se guardara el ETag
+        cols = {row[1] for row in self.con.execute("PRAGMA table_info(responses)")}
+        if "etag" not in cols:
+            self.con.execute("ALTER TABLE responses ADD COLUMN etag TEXT")
+        self.con.commit()
+
+    @staticmethod
+    def _hash(params: dict) -> str:
+        clean = {k: v for k, v in params.items() if k not in SECRET_PARAMS}
+        return hashlib.sha1(json.dumps(clean, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, endpoint: str, params: dict, ttl: float):
+        """Respuesta guardada si tiene menos de ttl segundos, si no None."""
+        row = self.con.execute(
+            "SELECT fetched_at, body FROM responses WHERE endpoint = ? AND params_hash = ?",
+            (endpoint, self._hash(params)),
+        ).fetchone()
+        if row is None or time.time() - row[0] > ttl:
+            return None
+        return json.loads(row[1])
+
+    def get_stale(self, endpoint: str, params: dict):
+        """(respuesta, etag) guardados sin importar su edad, o None."""
+        row = self.con.execute(
+            "SELECT body, etag FROM responses WHERE endpoint = ? AND params_hash = ?",
+            (endpoint, self._hash(params)),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, endpoint: str, params: dict, data, etag: str = None) -> None:
+        self.con.execute(
+            "INSERT OR REPLACE INTO responses (endpoint, params_hash, fetched_at, body, etag)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (endpoint, self._hash(params), time.time(), json.dumps(data), etag),
+        )
+        self.con.commit()
+
+    def touch(self, endpoint: str, params: dict) -> None:
+        """Renueva fetched_at de una entrada revalidada (304 Not Modified)."""
+        self.con.execute(
+            "UPDATE responses SET fetched_at = ? WHERE endpoint = ? AND params_hash = ?",
+            (time.time(), endpoint, self._hash(params)),
+        )
+        self.con.commit()
+
+    def close(self) -> None:
+        self.con.close()
@@ -1,11 +1,18 @@
 import argparse
+import asyncio
+import contextlib
+import heapq
 import logging
+import httpx
 import requests
 import csv
 import time
 import os
 import tempfile
 import shutil
+from types import MappingProxyType
+
+from response_cache import ResponseCache
 
 # tqdm is optional; fall back to identity iterator if missing
 try:
@@ -25,9 +32,20 @@ GENRES_FILE = "steam_genres.csv"
 ML_FILE = "steam_ml_dataset.csv"
 COUNTRY_CODE = "us"
 LANG = "en"
-REQUEST_DELAY = 1.2        # seconds (do not go lower)
+REQUEST_DELAY = 1.2        # seconds between app starts (do not go lower)
+CONCURRENCY = 8            # apps in flight at once; pacing still obeys REQUEST_DELAY
+CACHE_DB = ".http_cache.sqlite"
+DETAILS_TTL = 24 * 3600    # seconds an appdetails response is reused across runs
 MAX_APPS = 100             # 🔴 set to None for full run
 TOP_N_MOST_RATED = 300    # set to None to disable (collects top-N by review count)
+WRITE_BUFFER = 1 << 20     # bytes of buffering per CSV handle during a run
+_EMPTY = MappingProxyType({})   # shared read-only default for missing/null sub-objects
+
+METADATA_HEADER = ["appId", "nombre", "release_date", "metacritic_score", "genres", "platforms", "is_free"]
+REVIEWS_HEADER = ["appId", "total_reviews", "positive_ratio", "review_score"]
+PRICING_HEADER = ["appId", "price", "discount_percent", "is_free"]
+GENRES_HEADER = ["appId", "genre"]
+ML_HEADER = ["appId", "metacritic_score", "total_reviews", "positive_ratio", "price", "discount_percent", "is_free", "num_genres", "platforms_count"]
 
 # ===============================
 # HEADERS
@@ -61,8 +79,9 @@ def get_session(retries: int = 3, backoff_factor: float = 0.5, status_forcelist=
     s.headers.update(HEADERS)
     return s
 
-# module-level session (will be set in main)
+# module-level session and response cache (will be set in main)
 SESSION = None
+CACHE = None
 
 # logger
 logger = logging.getLogger("steam_collector")
@@ -92,10 +111,9 @@ def append_rows_safe(path, rows, header):
     - If file doesn't exist: write header + rows atomically.
     - If file exists: validate header matches; if not, move old file to .bak and create new with header+rows.
     - If header matches: append rows (fast path).
-    """
-    if not rows:
-        return
 
+    With rows=[] this only makes sure the file exists with the right header.
+    """
     if os.path.exists(path):
         try:
             with open(path, 'r', newline='', encoding='utf-8') as f:
@@ -112,6 +130,9 @@ def append_rows_safe(path, rows, header):
             _atomic_write_full(path, header, rows)
             return
 
+        if not rows:
+            return
+
         # header matches — append
         with open(path, 'a', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
@@ -167,50 +188,81 @@ def get_most_rated_appids(n):
     r.raise_for_status()
     data = r.json()
 
-    apps = []
-    for k, v in data.items():
+    def total_reviews(v):
         try:
-            pos = int(v.get("positive") or 0)
-            neg = int(v.get("negative") or 0)
+            return int(v.get("positive") or 0) + int(v.get("negative") or 0)
         except Exception:
-            pos = 0
-            neg = 0
-        total = pos + neg
-        apps.append({"appid": int(k), "name": v.get("name"), "total_reviews": total})
+            return 0
+
+    # nlargest keeps an n-sized heap instead of sorting all ~70k apps; like the
+    # stable sort it replaces, ties keep SteamSpy's order
+    top = heapq.nlargest(n, ((total_reviews(v), k, v) for k, v in data.items()), key=lambda t: t[0])
+    return [{"appid": int(k), "name": v.get("name"), "total_reviews": total} for total, k, v in top]
+
+RETRY_STATUS = (500, 502, 503, 504)
+
 
-    apps.sort(key=lambda x: x["total_reviews"], reverse=True)
-    return apps[:n]
+async def _get(client, url, params=None, retries=3, backoff_factor=0.5):
+    """GET with the same retry/backoff policy get_session() gives the sync calls."""
+    for attempt in range(retries + 1):
+        try:
+            r = await client.get(url, params=params)
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUS or attempt == retries:
+                return r
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+
+class RateLimiter:
+    """Hands out start slots at least `interval` seconds apart.
+
+    The slot is reserved under the lock and slept on outside it, so waiting
+    callers queue up in order without serializing the requests themselves.
+    """
 
-def get_app_details(appid):
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def get_app_details(client, appid):
     params = {
         "appids": appid,
         "cc": COUNTRY_CODE,
         "l": LANG
     }
 
-    sess = SESSION or requests
-    r = sess.get(
-        DETAILS_URL,
-        params=params,
-        timeout=30
-    )
+    body = CACHE.get("appdetails", params, DETAILS_TTL) if CACHE is not None else None
+    if body is None:
+        r = await _get(client, DETAILS_URL, params=params)
 
-    if r.status_code != 200:
-        return None
+        if r.status_code != 200:
+            return None
 
-    payload = r.json().get(str(appid))
+        body = r.json()
+        if CACHE is not None:
+            CACHE.set("appdetails", params, body)
+
+    payload = body.get(str(appid))
     if not payload or not payload.get("success"):
         return None
 
     return payload["data"]
 
-def get_review_data(appid):
-    sess = SESSION or requests
-    r = sess.get(
-        f"{REVIEWS_URL}{appid}",
-        params={"json": 1},
-        timeout=30
-    )
+async def get_review_data(client, appid):
+    r = await _get(client, f"{REVIEWS_URL}{appid}", params={"json": 1})
 
     if r.status_code != 200:
         return {}
@@ -230,13 +282,22 @@ def extract_price(data):
 # ===============================
 # MAIN
 # ===============================
+def positive_int(value):
+    """argparse type for ints >= 1 (a zero-slot semaphore would never let a request through)."""
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {n}")
+    return n
+
+
 def main():
-    global SESSION, MAX_APPS, TOP_N_MOST_RATED, REQUEST_DELAY, COUNTRY_CODE, LANG, OUTPUT_FILE, METADATA_FILE, REVIEWS_FILE, PRICING_FILE, GENRES_FILE, ML_FILE
+    global SESSION, CACHE, MAX_APPS, TOP_N_MOST_RATED, REQUEST_DELAY, CONCURRENCY, COUNTRY_CODE, LANG, OUTPUT_FILE, METADATA_FILE, REVIEWS_FILE, PRICING_FILE, GENRES_FILE, ML_FILE
 
     parser = argparse.ArgumentParser(description="Steam data collector")
     parser.add_argument("--max-apps", type=int, default=MAX_APPS)
     parser.add_argument("--top-n-most-rated", type=int, default=TOP_N_MOST_RATED)
     parser.add_argument("--request-delay", type=float, default=REQUEST_DELAY)
+    parser.add_argument("--concurrency", type=positive_int, default=CONCURRENCY)
     parser.add_argument("--country-code", default=COUNTRY_CODE)
     parser.add_argument("--lang", default=LANG)
     parser.add_argument("--output-file", default=OUTPUT_FILE)
@@ -245,12 +306,15 @@ def main():
     parser.add_argument("--pricing-file", default=PRICING_FILE)
     parser.add_argument("--genres-file", default=GENRES_FILE)
     parser.add_argument("--ml-file", default=ML_FILE)
+    parser.add_argument("--cache-db", default=CACHE_DB, help="SQLite file with cached appdetails responses")
+    parser.add_argument("--no-cache", action="store_true", help="always hit the Steam API")
     args = parser.parse_args()
 
     # apply overrides
     MAX_APPS = args.max_apps
     TOP_N_MOST_RATED = args.top_n_most_rated
     REQUEST_DELAY = args.request_delay
+    CONCURRENCY = args.concurrency
     COUNTRY_CODE = args.country_code
     LANG = args.lang
     OUTPUT_FILE = args.output_file
@@ -262,9 +326,12 @@ def main():
 
     # configure logging
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)   # one INFO line per request otherwise
 
     # create resilient session
     SESSION = get_session()
+    if not args.no_cache:
+        CACHE = ResponseCache(args.cache_db)
 
     # If TOP_N_MOST_RATED is set, use SteamSpy to pick the top N by review counts.
     if TOP_N_MOST_RATED:
@@ -272,107 +339,141 @@ def main():
     else:
         apps = get_all_appids()
 
-    # Ensure CSVs exist with correct headers (atomic)
-    append_rows_safe(METADATA_FILE, [], ["appId", "nombre", "release_date", "metacritic_score", "genres", "platforms", "is_free"])
-    append_rows_safe(REVIEWS_FILE, [], ["appId", "total_reviews", "positive_ratio", "review_score"])
-    append_rows_safe(PRICING_FILE, [], ["appId", "price", "discount_percent", "is_free"])
-    append_rows_safe(GENRES_FILE, [], ["appId", "genre"])
-    append_rows_safe(ML_FILE, [], ["appId", "metacritic_score", "total_reviews", "positive_ratio", "price", "discount_percent", "is_free", "num_genres", "platforms_count"])
+    with contextlib.ExitStack() as stack:
+        # Ensure CSVs exist with correct headers (atomic), then keep one buffered
+        # append handle + csv.writer per file open for the whole run
+        def open_writer(path, header):
+            append_rows_safe(path, [], header)
+            f = stack.enter_context(open(path, 'a', newline='', encoding='utf-8', buffering=WRITE_BUFFER))
+            return csv.writer(f)
 
-    for app in tqdm(apps):
-        appid = app["appid"]
+        meta_writer = open_writer(METADATA_FILE, METADATA_HEADER)
+        rev_writer = open_writer(REVIEWS_FILE, REVIEWS_HEADER)
+        pr_writer = open_writer(PRICING_FILE, PRICING_HEADER)
+        gen_writer = open_writer(GENRES_FILE, GENRES_HEADER)
+        ml_writer = open_writer(ML_FILE, ML_HEADER)
 
-        try:
-            details = get_app_details(appid)
-            if not details:
-                continue
+        asyncio.run(collect_apps(apps, meta_writer, rev_writer, pr_writer, gen_writer, ml_writer))
 
-            # Only video games
-            if details.get("type") != "game":
-                continue
+    logger.info("Dataset saved to %s (files: %s, %s, %s, %s, %s)", OUTPUT_FILE, METADATA_FILE, REVIEWS_FILE, PRICING_FILE, GENRES_FILE, ML_FILE)
 
-            reviews = get_review_data(appid) or {}
 
-            price, discount, is_free = extract_price(details)
+def build_rows(appid, details, reviews):
+    """Turn one app's details + review summary into its rows for each CSV."""
+    price, discount, is_free = extract_price(details)
 
-            release_info = details.get("release_date", {})
-            release_date = None
-            if not release_info.get("coming_soon"):
-                release_date = release_info.get("date")
+    release_info = details.get("release_date") or _EMPTY
+    release_date = None
+    if not release_info.get("coming_soon"):
+        release_date = release_info.get("date")
 
-            # Compute review totals and positive ratio safely
-            total_reviews = None
-            positive = None
-            if reviews:
-                total_reviews = reviews.get("total_reviews") or reviews.get("review_count")
-                positive = reviews.get("total_positive") or reviews.get("total_positive_reviews")
+    # Compute review totals and positive ratio safely
+    total_reviews = None
+    positive = None
+    if reviews:
+        total_reviews = reviews.get("total_reviews") or reviews.get("review_count")
+        positive = reviews.get("total_positive") or reviews.get("total_positive_reviews")
 
-            positive_ratio = None
+    positive_ratio = None
+    try:
+        if total_reviews and positive:
+            positive_ratio = float(positive) / float(total_reviews)
+    except Exception:
+        positive_ratio = None
+
+    # Genres and platforms
+    genres_list = [desc for g in details.get("genres") or () if (desc := g.get("description"))]
+    platforms = [p for p, v in (details.get("platforms") or _EMPTY).items() if v]
+    metacritic_score = (details.get("metacritic") or _EMPTY).get("score")
+
+    # Prepare rows
+    meta_row = [
+        appid,
+        details.get("name"),
+        release_date,
+        metacritic_score,
+        ";".join(genres_list),
+        ";".join(platforms),
+        is_free
+    ]
+
+    rev_row = [
+        appid,
+        total_reviews,
+        positive_ratio,
+        reviews.get("review_score")
+    ]
+
+    pr_row = [
+        appid,
+        price,
+        discount,
+        is_free
+    ]
+
+    gen_rows = [[appid, g] for g in genres_list]
+
+    num_genres = len(genres_list)
+    platforms_count = len(platforms)
+    ml_row = [
+        appid,
+        metacritic_score,
+        total_reviews,
+        positive_ratio,
+        price,
+        discount,
+        int(bool(is_free)),
+        num_genres,
+        platforms_count
+    ]
+
+    return meta_row, rev_row, pr_row, gen_rows, ml_row
+
+
+async def fetch_app(client, limiter, sem, appid):
+    """Rows for one appid, or None if it isn't a game / the store has no data."""
+    async with sem:
+        await limiter.wait()
+        details = await get_app_details(client, appid)
+        if not details:
+            return None
+
+        # Only video games
+        if details.get("type") != "game":
+            return None
+
+        reviews = await get_review_data(client, appid) or {}
+
+    return build_rows(appid, details, reviews)
+
+
+async def collect_apps(apps, meta_writer, rev_writer, pr_writer, gen_writer, ml_writer):
+    """Fetch apps concurrently and write each one's rows as soon as it completes."""
+    sem = asyncio.Semaphore(CONCURRENCY)
+    limiter = RateLimiter(REQUEST_DELAY)
+    timeout = httpx.Timeout(30, pool=60)
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=CONCURRENCY)
+
+    async with httpx.AsyncClient(headers=HEADERS, timeout=timeout, limits=limits) as client:
+
+        async def process(appid):
             try:
-                if total_reviews and positive:
-                    positive_ratio = float(positive) / float(total_reviews)
+                return await fetch_app(client, limiter, sem, appid)
             except Exception:
-                positive_ratio = None
-
-            # Genres and platforms
-            genres_list = [g.get("description") for g in details.get("genres", []) if g.get("description")]
-            platforms = [p for p, v in details.get("platforms", {}).items() if v]
-
-            # Prepare rows
-            meta_row = [
-                appid,
-                details.get("name"),
-                release_date,
-                details.get("metacritic", {}).get("score"),
-                ";".join(genres_list),
-                ";".join(platforms),
-                is_free
-            ]
-
-            rev_row = [
-                appid,
-                total_reviews,
-                positive_ratio,
-                reviews.get("review_score")
-            ]
-
-            pr_row = [
-                appid,
-                price,
-                discount,
-                is_free
-            ]
-
-            gen_rows = [[appid, g] for g in genres_list]
-
-            num_genres = len(genres_list)
-            platforms_count = len(platforms)
-            ml_row = [
-                appid,
-                details.get("metacritic", {}).get("score"),
-                total_reviews,
-                positive_ratio,
-                price,
-                discount,
-                int(bool(is_free)),
-                num_genres,
-                platforms_count
-            ]
-
-            # Append safely (atomic when creating or header mismatch)
-            append_rows_safe(METADATA_FILE, [meta_row], ["appId", "nombre", "release_date", "metacritic_score", "genres", "platforms", "is_free"])
-            append_rows_safe(REVIEWS_FILE, [rev_row], ["appId", "total_reviews", "positive_ratio", "review_score"])
-            append_rows_safe(PRICING_FILE, [pr_row], ["appId", "price", "discount_percent", "is_free"])
-            if gen_rows:
-                append_rows_safe(GENRES_FILE, gen_rows, ["appId", "genre"])
-            append_rows_safe(ML_FILE, [ml_row], ["appId", "metacritic_score", "total_reviews", "positive_ratio", "price", "discount_percent", "is_free", "num_genres", "platforms_count"])
-
-            time.sleep(REQUEST_DELAY)
+                logger.exception("Error with appid %s", appid)
+                return None
 
-        except Exception:
-            logger.exception("Error with appid %s", appid)
-
-    logger.info("Dataset saved to %s (files: %s, %s, %s, %s, %s)", OUTPUT_FILE, METADATA_FILE, REVIEWS_FILE, PRICING_FILE, GENRES_FILE, ML_FILE)
+        tasks = [process(app["appid"]) for app in apps]
+        for fut in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            rows = await fut
+            if rows is None:
+                continue
+            meta_row, rev_row, pr_row, gen_rows, ml_row = rows
+            meta_writer.writerow(meta_row)
+            rev_writer.writerow(rev_row)
+            pr_writer.writerow(pr_row)
+            gen_writer.writerows(gen_rows)
+            ml_writer.writerow(ml_row)
 
 # ===============================
 if __name__ == "__main__":
@@ -10,24 +10,35 @@ Genera parquets particionados por anio y appid:
   histograms/
     year=2023/
       id=10/
-        data.parquet
+        data-<uuid>-0.parquet    <- uno nuevo por lote escrito, nunca se reescriben
     year=2024/
       ...
 
+Puede haber filas repetidas entre archivos de distintas ejecuciones;
+build_db.py las elimina al compactar.
+
 Uso:
-  pip install requests pandas pyarrow tqdm
+  pip install httpx[http2] numpy orjson pyarrow tqdm
   python steam_price_history.py --itad-key TU_API_KEY
 """
 
 import argparse
+import asyncio
 import logging
 import os
 import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-import pandas as pd
-import requests
-from requests.adapters import HTTPAdapter
+import httpx
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from response_cache import ResponseCache
 
 try:
     from tqdm import tqdm
@@ -35,11 +46,11 @@ except ImportError:
     def tqdm(x, **kwargs):
         return x
 
-try:
-    from urllib3.util import Retry
-    HAS_RETRY = True
+try:                                    # opcional: HTTP/2 hacia ITAD / Steam
+    import h2  # noqa: F401
+    HTTP2 = True
 except ImportError:
-    HAS_RETRY = False
+    HTTP2 = False
 
 # ===============================
 # CONFIG
@@ -48,111 +59,285 @@ TOP_N_MOST_RATED  = 300
 HISTORY_SINCE     = "2022-01-01T00:00:00Z"
 STEAM_SHOP_ID     = 61
 COUNTRY_CODE      = "US"
-REQUEST_DELAY     = 1.2
+REQUEST_DELAY     = 1.2          # segundos entre peticiones a un mismo host (en promedio)
+REQUEST_BURST     = 2            # peticiones seguidas permitidas a un host tras estar inactivo
+CONCURRENCY       = 8            # juegos descargandose a la vez
+WRITE_BATCH_ROWS  = 200_000      # registros acumulados (varios juegos) por escritura
+RESULT_QUEUE_SIZE = 64           # historiales descargados esperando al escritor
+ROW_GROUP_ROWS    = 8192         # filas por row group en los parquet
+DATA_PAGE_SIZE    = 1 << 20      # bytes por pagina de datos
+PARTITIONS_PER_WRITE = 512       # particiones year/id (= archivos abiertos) por write_dataset
+TREE_PRINT_LIMIT  = 500          # entradas del arbol de salida que se imprimen al final
 OUTPUT_DIR        = "histograms"
+CACHE_DB          = ".http_cache.sqlite"
+LOOKUP_TTL        = 24 * 3600    # ITAD game id de un appid: practicamente fijo
+HISTORY_TTL       = 3600         # historial de precios
+APP_TYPE_TTL      = 30 * 24 * 3600   # tipo de app en Steam (game, dlc, ...): casi nunca cambia
 
 STEAMSPY_URL      = "https://steamspy.com/api.php?request=all"
 STEAM_DETAILS_URL = "https://store.steampowered.com/api/appdetails"
 ITAD_LOOKUP_URL   = "https://api.isthereanydeal.com/games/lookup/v1"
+ITAD_BULK_URL     = "https://api.isthereanydeal.com/lookup/id/shop/61/v1"   # 61 = Steam
+BULK_LOOKUP_SIZE  = 200          # appids por POST al lookup en lote
 ITAD_HISTORY_URL  = "https://api.isthereanydeal.com/games/history/v2"
 
 HEADERS = {"User-Agent": "SteamPriceHistoryCollector/1.0 (academic project)"}
+# Tipos fijos de los parquet: sin inferencia por lote, y una columna toda nula
+# (p.ej. cut_pct) no sale con tipo null
+HISTORY_SCHEMA = pa.schema([
+    pa.field("timestamp",   pa.timestamp("us", tz="UTC")),
+    pa.field("price_usd",   pa.float64()),
+    pa.field("regular_usd", pa.float64()),
+    pa.field("cut_pct",     pa.int64()),
+    pa.field("shop_id",     pa.int64()),
+    pa.field("shop_name",   pa.string()),
+])
+HISTORY_COLUMNS = tuple(HISTORY_SCHEMA.names)
+RETRY_STATUS = (429, 500, 502, 503, 504)
 
 logger = logging.getLogger("steam_price_history")
-SESSION = None
+CACHE = None     # ResponseCache; None = sin cache (--no-cache)
+BUCKETS = {}     # host -> TokenBucket (ver http_get)
 
 
 # ===============================
-# SESSION
+# CLIENTE HTTP
 # ===============================
-def make_session() -> requests.Session:
-    s = requests.Session()
-    s.headers.update(HEADERS)
-    if HAS_RETRY:
-        retry = Retry(
-            total=4,
-            backoff_factor=1.0,
-            status_forcelist=(429, 500, 502, 503, 504),
-            allowed_methods=frozenset(["GET", "POST"]),
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        s.mount("https://", adapter)
-        s.mount("http://", adapter)
-    return s
+def make_client(concurrency: int) -> httpx.AsyncClient:
+    # Con h2 las peticiones a cada host se multiplexan sobre una conexion TLS
+    limits = httpx.Limits(max_connections=2 * concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(headers=HEADERS, http2=HTTP2, timeout=httpx.Timeout(30, pool=60),
+                             limits=limits)
+
+
+class TokenBucket:
+    """Deja pasar `rate` peticiones por segundo con rafagas de hasta `burst`.
+
+    Solo se duerme cuando no quedan fichas. La ficha se reserva bajo el lock
+    (el saldo puede quedar negativo) y se duerme fuera de el, asi los que
+    esperan salen en orden sin serializar las peticiones.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def throttle(url: str) -> None:
+    """Espera turno en el bucket del host de url (uno por host: ITAD, Steam, SteamSpy)."""
+    if REQUEST_DELAY <= 0:
+        return
+    host = httpx.URL(url).host
+    bucket = BUCKETS.get(host)
+    if bucket is None:
+        bucket = BUCKETS[host] = TokenBucket(1 / REQUEST_DELAY, REQUEST_BURST)
+    await bucket.acquire()
+
+
+async def http_get(client, url: str, params=None, timeout: float = 30,
+                   retries: int = 4, backoff_factor: float = 1.0, json=None, headers=None):
+    """GET (o POST si se pasa json) con reintentos y backoff exponencial ante
+    429/5xx o errores de red. Cada intento pasa por el bucket del host."""
+    for attempt in range(retries + 1):
+        await throttle(url)
+        try:
+            if json is None:
+                r = await client.get(url, params=params, headers=headers, timeout=timeout)
+            else:
+                r = await client.post(url, params=params, json=json, timeout=timeout)
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUS or attempt == retries:
+                return r
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+
+async def get_json(client, endpoint: str, url: str, params: dict, ttl: float, timeout: float):
+    """GET que pasa por CACHE. Devuelve (JSON, modificado); JSON es None si la
+    respuesta no es 200.
+
+    Una entrada vencida con ETag se revalida con If-None-Match: ante un 304 se
+    reutiliza sin volver a descargar el cuerpo. modificado es False cuando el
+    JSON sale de la cache (vigente o confirmada por un 304): es el mismo que ya
+    se uso en una corrida anterior.
+    """
+    stale = None
+    if CACHE is not None:
+        data = CACHE.get(endpoint, params, ttl)
+        if data is not None:
+            return data, False
+        stale = CACHE.get_stale(endpoint, params)
+
+    headers = {"If-None-Match": stale[1]} if stale and stale[1] else None
+    r = await http_get(client, url, params=params, timeout=timeout, headers=headers)
+    if r.status_code == 304 and stale is not None:
+        CACHE.touch(endpoint, params)
+        return stale[0], False
+    if r.status_code != 200:
+        logger.debug("%s devolvio %d", endpoint, r.status_code)
+        return None, True
+
+    data = orjson.loads(r.content)
+    if CACHE is not None:
+        CACHE.set(endpoint, params, data, etag=r.headers.get("etag"))
+    return data, True
 
 
 # ===============================
 # PASO 1 - Lista de juegos (SteamSpy)
 # ===============================
-def get_top_apps(n: int) -> list:
+async def get_top_apps(client, n: int) -> list:
     logger.info("Obteniendo top %d juegos de SteamSpy...", n)
-    r = SESSION.get(STEAMSPY_URL, timeout=60)
+    r = await http_get(client, STEAMSPY_URL, timeout=60)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
+
+    keys = list(data)
+    totals = np.fromiter((total_reviews(v) for v in data.values()), dtype=np.int64, count=len(keys))
+
+    # np.partition es O(N): da el n-esimo mayor total sin ordenar todo. Solo se
+    # ordenan los n elegidos; los empates quedan en el orden de SteamSpy.
+    if n <= 0:
+        top = np.arange(0)
+    elif n < len(keys):
+        cutoff = np.partition(totals, len(keys) - n)[len(keys) - n]
+        above = np.flatnonzero(totals > cutoff)
+        ties = np.flatnonzero(totals == cutoff)[: n - len(above)]
+        top = np.concatenate([above, ties])
+    else:
+        top = np.arange(len(keys))
+    top = top[np.lexsort((top, -totals[top]))]
+
+    logger.info("SteamSpy devolvio %d apps; limitando a %d.", len(keys), n)
+    return [
+        {
+            "appid": int(keys[i]),
+            "name": data[keys[i]].get("name", ""),
+            "total_reviews": int(totals[i]),
+        }
+        for i in top
+    ]
 
-    apps = []
-    for appid_str, v in data.items():
-        try:
-            pos = int(v.get("positive") or 0)
-            neg = int(v.get("negative") or 0)
-        except (ValueError, TypeError):
-            pos = neg = 0
-        apps.append({
-            "appid": int(appid_str),
-            "name": v.get("name", ""),
-            "total_reviews": pos + neg,
-        })
 
-    apps.sort(key=lambda x: x["total_reviews"], reverse=True)
-    logger.info("SteamSpy devolvio %d apps; limitando a %d.", len(apps), n)
-    return apps[:n]
+def total_reviews(v: dict) -> int:
+    try:
+        return int(v.get("positive") or 0) + int(v.get("negative") or 0)
+    except (ValueError, TypeError):
+        return 0
 
 
 # ===============================
 # PASO 2 - Verificar que sea un juego
 # ===============================
-def is_game(appid: int) -> bool:
+async def is_game(client, appid: int) -> bool:
+    key = {"appid": appid}
+    cached = CACHE.get("steam_app_type", key, APP_TYPE_TTL) if CACHE is not None else None
+    if cached is not None:
+        return cached["type"] == "game"
+
     try:
-        r = SESSION.get(
+        r = await http_get(
+            client,
             STEAM_DETAILS_URL,
             params={"appids": appid, "cc": COUNTRY_CODE.lower(), "l": "en"},
             timeout=20,
         )
         if r.status_code != 200:
             return False
-        payload = r.json().get(str(appid), {})
+        payload = orjson.loads(r.content).get(str(appid), {})
         if not payload.get("success"):
             return False
-        return payload.get("data", {}).get("type") == "game"
+        app_type = payload.get("data", {}).get("type")
     except Exception:
         return False
 
+    # Solo se guarda una respuesta valida; errores y success=false se reintentan
+    if CACHE is not None:
+        CACHE.set("steam_app_type", key, {"type": app_type})
+    return app_type == "game"
+
 
 # ===============================
 # PASO 3 - Obtener ITAD game ID
 # ===============================
-def get_itad_id(appid: int, api_key: str):
+async def get_itad_game(client, appid: int, api_key: str):
+    """{"id", "type", ...} del juego en ITAD, o None si no lo encuentra."""
     try:
-        r = SESSION.get(
+        data, _ = await get_json(
+            client,
+            "itad_lookup",
             ITAD_LOOKUP_URL,
-            params={"appid": appid, "key": api_key},   # <-- key como query param
+            {"appid": appid, "key": api_key},   # <-- key como query param
+            ttl=LOOKUP_TTL,
             timeout=15,
         )
-        if r.status_code != 200:
-            logger.debug("ITAD lookup devolvio %d para appid=%d", r.status_code, appid)
+        if data is None:
             return None
-        data = r.json()
         if data.get("found"):
-            return data["game"]["id"]
+            return data["game"]
     except Exception as exc:
         logger.warning("Error en lookup para appid=%d: %s", appid, exc)
     return None
 
 
+async def get_itad_ids_bulk(client, appids: list, api_key: str) -> dict:
+    """appid -> ITAD game id (None si ITAD no lo conoce), resuelto en lotes.
+
+    Los appids de un lote que falla no aparecen en el resultado: para esos
+    process_app vuelve a get_itad_game.
+    """
+    ids = {}
+    missing = []
+    for appid in appids:
+        cached = CACHE.get("itad_shop_id", {"appid": appid}, LOOKUP_TTL) if CACHE is not None else None
+        if cached is not None:
+            ids[appid] = cached["id"]
+        else:
+            missing.append(appid)
+
+    for i in range(0, len(missing), BULK_LOOKUP_SIZE):
+        chunk = missing[i:i + BULK_LOOKUP_SIZE]
+        try:
+            r = await http_get(client, ITAD_BULK_URL, params={"key": api_key},
+                               json=[f"app/{appid}" for appid in chunk], timeout=30)
+            if r.status_code != 200:
+                logger.warning("Lookup en lote devolvio %d (%d appids)", r.status_code, len(chunk))
+                continue
+            found = orjson.loads(r.content)
+        except Exception as exc:
+            logger.warning("Error en lookup en lote (%d appids): %s", len(chunk), exc)
+            continue
+
+        for appid in chunk:
+            game_id = found.get(f"app/{appid}")
+            ids[appid] = game_id
+            if CACHE is not None:
+                CACHE.set("itad_shop_id", {"appid": appid}, {"id": game_id})
+
+    return ids
+
+
 # ===============================
 # PASO 4 - Historial de precios (ITAD)
 # ===============================
-def get_price_history(itad_id: str, api_key: str, since: str) -> list:
+async def get_price_history(client, itad_id: str, api_key: str, since: str) -> tuple:
+    """(historial, modificado): historial en columnas {nombre: [valores]} (ver
+    HISTORY_COLUMNS), {} si no hay; modificado como en get_json."""
     try:
         params = {
             "id": itad_id,
@@ -163,75 +348,341 @@ def get_price_history(itad_id: str, api_key: str, since: str) -> list:
         if STEAM_SHOP_ID is not None:
             params["shops"] = STEAM_SHOP_ID
 
-        r = SESSION.get(
-            ITAD_HISTORY_URL,
-            params=params,
-            timeout=20,
-        )
-        if r.status_code != 200:
-            logger.debug("ITAD history devolvio %d para id=%s", r.status_code, itad_id)
-            return []
-        raw = r.json()
+        raw, modified = await get_json(client, "itad_history", ITAD_HISTORY_URL, params,
+                                       ttl=HISTORY_TTL, timeout=20)
+        if raw is None:
+            return {}, True
     except Exception as exc:
         logger.warning("Error obteniendo historial para %s: %s", itad_id, exc)
-        return []
+        return {}, True
 
-    records = []
+    # Se arma directamente por columnas: write_parquet las pasa a Arrow sin
+    # recorrer un dict por fila. El timestamp queda como texto ISO 8601 y se
+    # convierte de una vez en write_parquet (parse_timestamps).
+    records = {name: [] for name in HISTORY_COLUMNS}
     for entry in raw:
         try:
-            ts = datetime.fromisoformat(entry["timestamp"].replace("Z", "+00:00"))
+            ts          = entry["timestamp"]
             deal        = entry.get("deal", {}) or {}
             price_obj   = deal.get("price", {}) or {}
             regular_obj = deal.get("regular", {}) or {}
             shop        = entry.get("shop", {}) or {}
-
-            records.append({
-                "timestamp":   ts,
-                "price_usd":   price_obj.get("amount"),
-                "regular_usd": regular_obj.get("amount"),
-                "cut_pct":     deal.get("cut"),
-                "shop_id":     shop.get("id"),
-                "shop_name":   shop.get("name"),
-            })
+            row = (ts, price_obj.get("amount"), regular_obj.get("amount"),
+                   deal.get("cut"), shop.get("id"), shop.get("name"))
         except Exception:
             continue
+        for name, value in zip(HISTORY_COLUMNS, row):
+            records[name].append(value)
 
-    return records
+    return (records if records["timestamp"] else {}), modified
 
 
 # ===============================
 # PASO 5 - Escribir parquet particionado
 # ===============================
-def write_parquet(appid: int, records: list, output_dir: str) -> int:
-    if not records:
+def init_writer() -> None:
+    """Inicializador de los procesos escritores: Arrow asigna con jemalloc, que
+    devuelve memoria al sistema entre lote y lote, si esta compilado."""
+    try:
+        pa.set_memory_pool(pa.jemalloc_memory_pool())
+    except NotImplementedError:
+        pass   # build de pyarrow sin jemalloc: queda el pool por defecto
+
+
+def _parse_ts(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except Exception:
+        return None
+
+
+def parse_timestamps(values: list) -> pa.Array:
+    """Textos ISO 8601 -> timestamp UTC con un solo cast de Arrow (en C).
+
+    Si algun valor no parsea se cae al parser de Python fila a fila; los que
+    tampoco parsean quedan nulos y write_parquet descarta esas filas.
+    """
+    ts_type = HISTORY_SCHEMA.field("timestamp").type
+    try:
+        return pa.array(values, type=pa.string()).cast(ts_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([_parse_ts(v) for v in values], type=ts_type)
+
+
+class SchemaMismatch(ValueError):
+    """Un historial del lote no encaja en HISTORY_SCHEMA (ver write_batch)."""
+
+
+def history_table(batch: list) -> pa.Table:
+    """Tabla Arrow de un lote [(appid, registros), ...] con appid, year e id."""
+    columns = {name: [] for name in HISTORY_COLUMNS}
+    appids = []
+    for appid, records in batch:
+        for name in HISTORY_COLUMNS:
+            columns[name].extend(records[name])
+        appids.extend([appid] * len(records["timestamp"]))
+
+    columns["timestamp"] = parse_timestamps(columns["timestamp"])
+    table = pa.table(columns, schema=HISTORY_SCHEMA)
+    appid_col = pa.array(appids, type=pa.int64())
+    table = (table.append_column("appid", appid_col)
+                  .append_column("year", pc.year(table["timestamp"]))
+                  .append_column("id", appid_col))   # clave de particion; appid sigue dentro del archivo
+    return table.filter(pc.is_valid(table["timestamp"]))
+
+
+def partition_chunks(table: pa.Table, limit: int) -> list:
+    """Reparte los appids de la tabla en grupos de como mucho `limit` particiones year/id."""
+    per_app = table.group_by(["id", "year"]).aggregate([]).group_by("id").aggregate([("year", "count")])
+    chunks, current, parts = [], [], 0
+    for appid, n in zip(per_app["id"].to_pylist(), per_app["year_count"].to_pylist()):
+        if current and parts + n > limit:
+            chunks.append(current)
+            current, parts = [], 0
+        current.append(appid)
+        parts += n
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def write_parquet(batch: list, output_dir: str) -> int:
+    """Escribe un lote [(appid, registros), ...] con write_dataset.
+
+    Devuelve cuantos archivos se crearon (uno por particion year/id del lote).
+    Un lote grande abarca mas particiones de las que write_dataset acepta de una
+    vez, asi que se escribe en tramos de PARTITIONS_PER_WRITE particiones.
+    """
+    if not batch:
         return 0
+    try:
+        table = history_table(batch)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as exc:
+        raise SchemaMismatch(str(exc)) from exc
+    if table.num_rows == 0:
+        return 0
+
+    # Solo se agregan archivos nuevos: no se lee ni reescribe lo anterior. Los
+    # duplicados (timestamp, shop_id) entre ejecuciones se quitan en build_db.py.
+    parquet = ds.ParquetFileFormat()
+    file_options = parquet.make_write_options(
+        compression="zstd", compression_level=3,     # igual que el export de build_db.py
+        use_dictionary=True, write_statistics=True,
+        data_page_size=DATA_PAGE_SIZE,
+    )
+    basename = f"data-{uuid.uuid4().hex}-{{i}}.parquet"
+    written = []
+    for appids in partition_chunks(table, PARTITIONS_PER_WRITE):
+        ds.write_dataset(
+            table.filter(pc.is_in(table["id"], value_set=pa.array(appids, type=pa.int64()))),
+            output_dir,
+            format=parquet,
+            file_options=file_options,
+            max_rows_per_group=ROW_GROUP_ROWS,
+            max_partitions=PARTITIONS_PER_WRITE,
+            max_open_files=PARTITIONS_PER_WRITE,
+            partitioning=["year", "id"],
+            partitioning_flavor="hive",
+            basename_template=basename,
+            existing_data_behavior="overwrite_or_ignore",
+            file_visitor=written.append,
+        )
+    return len(written)
 
-    df = pd.DataFrame(records)
-    df["appid"] = appid
-    df["year"]  = df["timestamp"].dt.year
 
-    written = 0
-    for year, group in df.groupby("year"):
-        path = os.path.join(output_dir, f"year={year}", f"id={appid}")
-        os.makedirs(path, exist_ok=True)
-        out_file = os.path.join(path, "data.parquet")
+# ===============================
+# PIPELINE POR JUEGO
+# ===============================
+async def process_app(client, itad_ids: dict, on_disk: set, app: dict, args) -> tuple:
+    """(resultado, appid, registros) de un juego; resultado es "con_historial" o
+    una clave de stats. on_disk son los appids que ya tienen datos escritos."""
+    appid = app["appid"]
+    name  = app.get("name", f"appid_{appid}")
+
+    # Primero el ITAD id (normalmente ya resuelto en lote, sin peticion): sin id
+    # no hay historial y tampoco hace falta preguntar a Steam el tipo
+    game_type = None
+    if appid in itad_ids:
+        itad_id = itad_ids[appid]
+    else:
+        game = await get_itad_game(client, appid, args.itad_key) or {}
+        itad_id, game_type = game.get("id"), game.get("type")
+    if not itad_id:
+        logger.info("Sin ITAD ID para appid=%d (%s)", appid, name)
+        return "sin_itad_id", appid, None
+
+    # El lookup individual de ITAD ya trae el tipo; solo si falta se consulta Steam
+    if not args.skip_game_check:
+        if game_type is not None:
+            game = game_type == "game"
+        else:
+            game = await is_game(client, appid)
+        if not game:
+            logger.debug("Saltando appid=%d (%s): no es juego", appid, name)
+            return "no_es_juego", appid, None
+
+    records, modified = await get_price_history(client, itad_id, args.itad_key, args.since)
+    if not records:
+        logger.info("Sin historial para appid=%d (%s)", appid, name)
+        return "sin_historial", appid, None
+    # Historial sacado de la cache o confirmado por un 304: es el mismo que se
+    # escribio en una corrida anterior; reescribirlo solo duplicaria parquets
+    if not modified and appid in on_disk:
+        logger.debug("appid=%d (%s): historial sin cambios, no se reescribe", appid, name)
+        return "sin_cambios", appid, None
 
-        if os.path.exists(out_file):
-            existing = pd.read_parquet(out_file)
-            group = pd.concat([existing, group], ignore_index=True)
-            group = group.drop_duplicates(subset=["timestamp", "shop_id"])
+    logger.info("appid=%d (%s): %d registros de precio", appid, name, len(records["timestamp"]))
+    return "con_historial", appid, records
 
-        group.to_parquet(out_file, index=False, engine="pyarrow")
-        written += 1
 
-    return written
+async def write_batch(pool, batch: list, output_dir: str, stats: dict) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+        # El await va aparte: "stats[...] += await ..." lee el contador antes de
+        # esperar y pisaria lo que sumaron otros write_batch en el medio
+        written = await loop.run_in_executor(pool, write_parquet, batch, output_dir)
+        stats["parquets_escritos"] += written
+        stats["procesados"] += len(batch)
+    except SchemaMismatch as exc:
+        # Un valor que no encaja en HISTORY_SCHEMA (p.ej. un shop.id "61" como
+        # texto) hace fallar la conversion del lote entero, antes de escribir
+        # nada: se reintenta juego por juego y solo se pierde el culpable
+        if len(batch) == 1:
+            logger.error("Historial de appid=%d no encaja en el esquema: %s", batch[0][0], exc)
+            stats["errores"] += 1
+            return
+        logger.warning("Lote de %d juegos no encaja en el esquema (%s); reintentando de a uno",
+                       len(batch), exc)
+        await asyncio.gather(*(write_batch(pool, [item], output_dir, stats) for item in batch))
+    except Exception:
+        logger.exception("Error escribiendo parquet de %d juegos", len(batch))
+        stats["errores"] += len(batch)
+
+
+def written_appids(output_dir: str) -> set:
+    """appids que ya tienen datos en output_dir (directorios year=*/id=*)."""
+    done = set()
+    if not os.path.isdir(output_dir):
+        return done
+    with os.scandir(output_dir) as years:
+        for year in years:
+            if not (year.is_dir() and year.name.startswith("year=")):
+                continue
+            with os.scandir(year.path) as ids:
+                for entry in ids:
+                    if entry.is_dir() and entry.name.startswith("id="):
+                        try:
+                            done.add(int(entry.name[3:]))
+                        except ValueError:
+                            pass
+    return done
+
+
+async def collect(args, stats: dict) -> None:
+    """Pipeline descarga -> escritura.
+
+    --concurrency tareas descargan juegos y dejan el resultado en una cola
+    acotada; un unico consumidor junta historiales en lotes y los manda al pool
+    de procesos. Con --write-workers lotes en vuelo el consumidor espera a que
+    termine uno, la cola se llena y las descargas se frenan solas: la memoria
+    queda acotada aunque escribir vaya mas lento que descargar.
+    """
+    async with make_client(args.concurrency) as client:
+        apps = await get_top_apps(client, args.top_n)
+        on_disk = written_appids(args.output_dir)
+        if args.resume:
+            pending = [app for app in apps if app["appid"] not in on_disk]
+            stats["ya_escritos"] = len(apps) - len(pending)
+            logger.info("--resume: %d juegos ya tienen datos en %s, se saltan",
+                        stats["ya_escritos"], args.output_dir)
+            apps = pending
+        itad_ids = await get_itad_ids_bulk(client, [app["appid"] for app in apps], args.itad_key)
+
+        todo = asyncio.Queue()
+        for app in apps:
+            todo.put_nowait(app)
+        results = asyncio.Queue(maxsize=RESULT_QUEUE_SIZE)
+
+        async def fetch_worker():
+            while not todo.empty():
+                app = todo.get_nowait()
+                try:
+                    result = await process_app(client, itad_ids, on_disk, app, args)
+                except Exception:
+                    logger.exception("Error procesando appid=%d (%s)", app["appid"], app.get("name"))
+                    result = ("errores", app["appid"], None)
+                await results.put(result)
+
+        fetchers = [asyncio.ensure_future(fetch_worker()) for _ in range(args.concurrency)]
+
+        with ProcessPoolExecutor(max_workers=args.write_workers, initializer=init_writer) as pool:
+            writes = set()
+            batch, batch_rows = [], 0
+
+            async def flush():
+                nonlocal batch, batch_rows
+                while len(writes) >= args.write_workers:
+                    _, pending = await asyncio.wait(writes, return_when=asyncio.FIRST_COMPLETED)
+                    writes.intersection_update(pending)
+                writes.add(asyncio.ensure_future(write_batch(pool, batch, args.output_dir, stats)))
+                batch, batch_rows = [], 0
+
+            try:
+                for _ in tqdm(range(len(apps)), desc="Procesando juegos"):
+                    result, appid, records = await results.get()
+                    if records is None:
+                        stats[result] += 1
+                        continue
+                    batch.append((appid, records))
+                    batch_rows += len(records["timestamp"])
+                    if batch_rows >= args.write_batch_rows:
+                        await flush()
+
+                if batch:
+                    await flush()
+                if writes:
+                    await asyncio.wait(writes)
+            finally:
+                for task in fetchers:
+                    task.cancel()
+                await asyncio.gather(*fetchers, return_exceptions=True)
+
+
+def print_tree(root: str, limit: int = TREE_PRINT_LIMIT) -> None:
+    """Imprime el arbol de salida con os.scandir; pasadas `limit` entradas solo las cuenta."""
+    count = 0
+
+    def walk(path: str, depth: int) -> None:
+        nonlocal count
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            is_dir = entry.is_dir()
+            count += 1
+            if count <= limit:
+                print(f"{'  ' * depth}{entry.name}{'/' if is_dir else ''}")
+            if is_dir:
+                walk(entry.path, depth + 1)
+
+    print(f"{os.path.basename(os.path.normpath(root))}/")
+    walk(root, 1)
+    if count > limit:
+        print(f"... y {count - limit} entradas mas ({count} en total)")
 
 
 # ===============================
 # MAIN
 # ===============================
+def positive_int(value: str) -> int:
+    """type= de argparse para enteros >= 1 (con 0 workers el pipeline no avanza)."""
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"debe ser >= 1, no {n}")
+    return n
+
+
 def main():
-    global SESSION, COUNTRY_CODE, REQUEST_DELAY, STEAM_SHOP_ID
+    global CACHE, COUNTRY_CODE, REQUEST_DELAY, REQUEST_BURST, STEAM_SHOP_ID
 
     parser = argparse.ArgumentParser(description="Steam price history - parquet particionado")
     parser.add_argument("--itad-key",        required=True,  help="API key de IsThereAnyDeal")
@@ -240,11 +691,27 @@ def main():
                         help="Fecha ISO 8601 desde cuando traer historial (ej: 2022-01-01T00:00:00Z)")
     parser.add_argument("--country",         default=COUNTRY_CODE)
     parser.add_argument("--output-dir",      default=OUTPUT_DIR)
-    parser.add_argument("--delay",           type=float, default=REQUEST_DELAY)
+    parser.add_argument("--delay",           type=float, default=REQUEST_DELAY,
+                        help="Segundos entre peticiones a un mismo host, en promedio (0 = sin limite)")
+    parser.add_argument("--burst",           type=int,   default=REQUEST_BURST,
+                        help="Peticiones seguidas permitidas a un host antes de aplicar --delay")
+    parser.add_argument("--concurrency",     type=positive_int, default=CONCURRENCY,
+                        help="Juegos descargandose en paralelo")
     parser.add_argument("--all-shops",       action="store_true",
                         help="Incluir todos los shops, no solo Steam")
     parser.add_argument("--skip-game-check", action="store_true",
                         help="Omitir verificacion de tipo game en Steam API (mas rapido)")
+    parser.add_argument("--cache-db",        default=CACHE_DB,
+                        help="SQLite con respuestas Steam / ITAD cacheadas entre ejecuciones")
+    parser.add_argument("--no-cache",        action="store_true",
+                        help="Ignorar la cache y pedir todo de nuevo")
+    parser.add_argument("--write-workers",   type=positive_int, default=os.cpu_count() or 1,
+                        help="Procesos que escriben parquet en paralelo a las descargas")
+    parser.add_argument("--write-batch-rows", type=int, default=WRITE_BATCH_ROWS,
+                        help="Registros de varios juegos que se juntan antes de escribir")
+    parser.add_argument("--resume",          action="store_true",
+                        help="Saltar los juegos que ya tienen datos en --output-dir "
+                             "(retomar una ejecucion cortada)")
     parser.add_argument("--log-level",       default="INFO")
     args = parser.parse_args()
 
@@ -252,75 +719,37 @@ def main():
         level=args.log_level.upper(),
         format="%(asctime)s %(levelname)s %(message)s",
     )
+    logging.getLogger("httpx").setLevel(logging.WARNING)   # si no, una linea INFO por peticion
 
     COUNTRY_CODE  = args.country
     REQUEST_DELAY = args.delay
+    REQUEST_BURST = max(1, args.burst)
     if args.all_shops:
         STEAM_SHOP_ID = None
 
-    SESSION = make_session()
+    if not args.no_cache:
+        CACHE = ResponseCache(args.cache_db)
     os.makedirs(args.output_dir, exist_ok=True)
 
-    apps = get_top_apps(args.top_n)
-
-    stats = {"procesados": 0, "sin_itad_id": 0, "sin_historial": 0,
-             "parquets_escritos": 0, "errores": 0}
-
-    for app in tqdm(apps, desc="Procesando juegos"):
-        appid = app["appid"]
-        name  = app.get("name", f"appid_{appid}")
-
-        try:
-            if not args.skip_game_check:
-                if not is_game(appid):
-                    logger.debug("Saltando appid=%d (%s): no es juego", appid, name)
-                    time.sleep(args.delay * 0.5)
-                    continue
-                time.sleep(args.delay * 0.5)
-
-            itad_id = get_itad_id(appid, args.itad_key)
-            if not itad_id:
-                logger.info("Sin ITAD ID para appid=%d (%s)", appid, name)
-                stats["sin_itad_id"] += 1
-                time.sleep(args.delay)
-                continue
-
-            records = get_price_history(itad_id, args.itad_key, args.since)
-            if not records:
-                logger.info("Sin historial para appid=%d (%s)", appid, name)
-                stats["sin_historial"] += 1
-                time.sleep(args.delay)
-                continue
-
-            logger.info("appid=%d (%s): %d registros de precio", appid, name, len(records))
-
-            written = write_parquet(appid, records, args.output_dir)
-            stats["parquets_escritos"] += written
-            stats["procesados"] += 1
-
-        except Exception:
-            logger.exception("Error procesando appid=%d (%s)", appid, name)
-            stats["errores"] += 1
-
-        time.sleep(args.delay)
+    stats = {"procesados": 0, "ya_escritos": 0, "no_es_juego": 0, "sin_itad_id": 0,
+             "sin_historial": 0, "sin_cambios": 0, "parquets_escritos": 0, "errores": 0}
+    asyncio.run(collect(args, stats))
 
     logger.info("=" * 50)
     logger.info("RESUMEN FINAL")
     logger.info("  Juegos con datos escritos : %d", stats["procesados"])
+    if args.resume:
+        logger.info("  Ya escritos (--resume)    : %d", stats["ya_escritos"])
     logger.info("  Sin ITAD ID               : %d", stats["sin_itad_id"])
     logger.info("  Sin historial de precios  : %d", stats["sin_historial"])
+    logger.info("  Sin cambios (304/cache)   : %d", stats["sin_cambios"])
     logger.info("  Archivos parquet escritos : %d", stats["parquets_escritos"])
     logger.info("  Errores                   : %d", stats["errores"])
     logger.info("Directorio de salida        : %s", os.path.abspath(args.output_dir))
     logger.info("=" * 50)
 
     print("\nEstructura generada:")
-    for root, dirs, files in os.walk(args.output_dir):
-        depth = root.replace(args.output_dir, "").count(os.sep)
-        indent = "  " * depth
-        print(f"{indent}{os.path.basename(root)}/")
-        for f in files:
-            print(f"{indent}  {f}")
+    print_tree(args.output_dir)
 
 
 if __name__ == "__main__":